@@ -1,11 +1,18 @@
 """ CITES trade network interactive Streamlit powered dashboard. """
 
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import duckdb as dk
+import igraph as ig
 import networkx as nx
+import numpy as np
 import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
 from pyvis.network import Network
+from scipy.sparse.csgraph import shortest_path
 
 st.set_page_config(layout="wide")
 # Set header title
@@ -19,242 +26,333 @@ st.markdown(
     [https://cites.org/eng/disc/parties/chronolo.php]"""
 )
 
-# Read dataset (CSV)
-tax = dk.query(" select distinct c.Taxon from 'data/cites_data.parquet' c ").df()
-
-# Summary data
-sm_taxon = dk.query(
-    " select count(distinct c.Taxon) as taxon from 'data/cites_data.parquet' c "
-).df()
-sm_import = dk.query(
-    " select count(distinct c.Importer) as importer from 'data/cites_data.parquet' c "
-).df()
-sm_export = dk.query(
-    " select count(distinct c.Exporter) as exporter from 'data/cites_data.parquet' c "
-).df()
-sm_max_spp = dk.query(
-    " select count(distinct c.Exporter) as exporter from 'data/cites_data.parquet' c "
-).df()
-taxon_num = sm_taxon["taxon"].values[0].astype(str)
-import_num = sm_import["importer"].values[0].astype(str)
-export_num = sm_export["exporter"].values[0].astype(str)
+DATA_PATH = "data/cites_data.parquet"
+
+
+# One connection per parquet file version: DuckDB fixes a view's column types
+# when it is created, so a rewritten file needs a fresh trades view
+@st.cache_resource(max_entries=1)
+def get_con(version):
+    """DuckDB connection for a parquet file version, shared across sessions."""
+    con = dk.connect()
+    con.execute("PRAGMA memory_limit='2GB'")
+    # Results that need an order ask for it, so scans may emit rows as they finish
+    con.execute("PRAGMA preserve_insertion_order=false")
+    # Keep parquet metadata (row group statistics) cached between queries
+    con.execute("PRAGMA enable_object_cache")
+    con.execute(f"create view trades as select * from read_parquet('{DATA_PATH}')")
+    return con
+
+
+def run_query(version, sql, params=None, **tables):
+    """Arrow result of a query on its own cursor, closed once fetched.
+
+    Keyword arguments register Arrow tables under their names for the query.
+    """
+    cur = get_con(version).cursor()
+    try:
+        for name, table in tables.items():
+            cur.register(name, table)
+        return cur.execute(sql, params).fetch_arrow_table()
+    finally:
+        cur.close()
+
+
+# Distinct taxa for the taxon selectbox
+TAXA_QUERY = "select distinct c.Taxon from trades c order by c.Taxon"
+
+# Distinct taxa, importer and exporter counts in a single scan
+SUMMARY_QUERY = """select count(distinct c.Taxon)
+    ,count(distinct c.Importer)
+    ,count(distinct c.Exporter)
+    from trades c"""
+
+
+@st.cache_data(ttl=None)
+def load_landing(version):
+    """Taxa list and summary counts, queried concurrently on separate cursors."""
+
+    def taxa_list():
+        table = run_query(version, TAXA_QUERY)
+        return tuple(table.column("Taxon").to_pylist())
+
+    def summary_counts():
+        table = run_query(version, SUMMARY_QUERY)
+        return tuple(column[0].as_py() for column in table.columns)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        taxa = pool.submit(taxa_list)
+        summary = pool.submit(summary_counts)
+        return taxa.result(), summary.result()
+
+
+# Columns shown in the raw data table (plus the country names used for edges)
+RAW_COLUMNS = """cast(c.Id as varchar) as Id
+    ,cast(c.Year as varchar) as Year
+    ,c.Taxon
+    ,c.Term
+    ,c.Quantity
+    ,c.Unit
+    ,c.Exporter
+    ,c.export_ctry
+    ,c.Importer
+    ,c.import_ctry
+    ,c.Purpose
+    ,c.Source"""
+
+# Trade weights per exporter/importer pair in the filtered rows
+EDGE_QUERY = """select c.Exporter as exporter
+    ,c.export_ctry
+    ,c.Importer as importer
+    ,c.import_ctry
+    ,sum(c.Quantity) as weight
+    from raw c
+    where c.export_ctry is not null and c.import_ctry is not null
+    group by c.Exporter, c.export_ctry, c.Importer, c.import_ctry
+    order by c.export_ctry, c.import_ctry"""
+
+
+# Arrow tables are immutable, so share them instead of copying on every cache hit
+@st.cache_resource(show_spinner=False, max_entries=32)
+def load_scope(version, taxon, year_from, year_to):
+    """Raw-table rows for a taxon and year range, read from parquet once."""
+    return run_query(
+        version,
+        f"""select {RAW_COLUMNS} from trades c
+        where c.Taxon = ? and c.Year between ? and ?
+        order by c.Year, c.Id""",
+        [taxon, year_from, year_to],
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_terms(version, taxon, year_from, year_to):
+    """Sorted distinct trade terms for a taxon and year range."""
+    table = run_query(
+        version,
+        "select distinct c.Term from scope c order by c.Term",
+        scope=load_scope(version, taxon, year_from, year_to),
+    )
+    return tuple(table.column("Term").to_pylist())
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def load_raw(version, taxon, year_from, year_to, term=None):
+    """Raw-table rows for a filter, narrowed from the cached scope table."""
+    scope = load_scope(version, taxon, year_from, year_to)
+    if term is None:
+        return scope
+    # Year and Id are text in the scope table; four-digit years sort as text
+    return run_query(
+        version,
+        """select * from scope c where c.Term = ?
+        order by c.Year, cast(c.Id as bigint)""",
+        [term],
+        scope=scope,
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def filter_by_taxon(version, taxon, year_from, year_to, term=None):
+    """Edge weights for a taxon, year range and optional term."""
+    return run_query(
+        version,
+        EDGE_QUERY,
+        raw=load_raw(version, taxon, year_from, year_to, term),
+    )
+
+
+def closeness_centrality(species):
+    """Closeness centrality matching NetworkX, from scipy's C shortest paths."""
+    nodes = list(species)
+    size = len(nodes)
+    dist = shortest_path(
+        nx.to_scipy_sparse_array(species, nodelist=nodes, weight=None),
+        directed=True,
+        unweighted=True,
+    )
+    # NetworkX uses incoming distances on directed graphs (columns here)
+    reach = np.isfinite(dist)
+    total = np.where(reach, dist, 0).sum(axis=0)
+    n_reach = reach.sum(axis=0) - 1
+    cent = np.divide(n_reach, total, out=np.zeros(size), where=total > 0)
+    if size > 1:
+        # Wasserman-Faust scaling for graphs that are not strongly connected
+        cent *= n_reach / (size - 1)
+    return dict(zip(nodes, cent.tolist()))
+
+
+def betweenness_centrality(species):
+    """Normalized betweenness centrality matching NetworkX, computed by igraph."""
+    nodes = list(species)
+    size = len(nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    graph = ig.Graph(
+        n=size,
+        edges=[(index[u], index[v]) for u, v in species.edges()],
+        directed=True,
+    )
+    cent = graph.betweenness(directed=True)
+    scale = 1 / ((size - 1) * (size - 2)) if size > 2 else 1
+    return {node: value * scale for node, value in zip(nodes, cent)}
+
+
+# Node scaling options and the NetworkX measure behind each
+CENTRALITY = {
+    "Degree (connections)": nx.degree_centrality,
+    "In-Degree (incoming connections)": nx.in_degree_centrality,
+    "Out-Degree (outgoing connections)": nx.out_degree_centrality,
+    "Eigenvector (centrality of neighbors)": nx.eigenvector_centrality,
+    "Closeness (distance to other nodes)": closeness_centrality,
+    "Betweenness (frequency as shortest path)": betweenness_centrality,
+}
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def compute_centrality(edges, method):
+    """Node centrality of the directed trade graph, cached per edge list."""
+    species = nx.DiGraph()
+    species.add_edges_from(edges)
+    return CENTRALITY[method](species)
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_graph_html(version, taxon, year_from, year_to, term, weighted, centrality):
+    """PyVis page for the filtered trade graph, with every node grey."""
+    data = filter_by_taxon(version, taxon, year_from, year_to, term)
+    exporters = data.column("export_ctry").to_numpy()
+    importers = data.column("import_ctry").to_numpy()
+    widths = data.column("weight").to_pylist() if weighted else None
+
+    # Adding scaling for node size
+    cent = {}
+    if centrality:
+        cent = compute_centrality(tuple(zip(exporters, importers)), centrality)
+
+    # Build the PyVis graph straight from the edge list
+    anim_net = Network(
+        height="900px", bgcolor="white", font_color="blue", directed=True
+    )
+    nodes = pd.unique(np.column_stack((exporters, importers)).ravel())
+    for node in nodes:
+        anim_net.add_node(
+            node, size=int(100 * cent[node]) if cent else 10, color="grey"
+        )
+    for i in range(len(exporters)):
+        anim_net.add_edge(
+            exporters[i], importers[i], width=widths[i] if weighted else 1
+        )
+
+    # Generate network with specific layout settings
+    anim_net.repulsion(
+        node_distance=420,
+        central_gravity=0.33,
+        spring_length=110,
+        spring_strength=0.10,
+        damping=0.95,
+    )
+    return anim_net.generate_html()
+
+
+@st.fragment
+def render_graph(version, taxon, year_from, year_to, term):
+    """Graph and tables for a filter; its widgets rerun only this fragment."""
+    data = filter_by_taxon(version, taxon, year_from, year_to, term)
+
+    # Select Importer and Exporter colors
+    ex_filter = st.selectbox(
+        "Select/Type the :orange[Exporter]",
+        sorted(data.column("export_ctry").unique().to_pylist()),
+    )
+    im_filter = st.selectbox(
+        "Select/Type the :red[Importer]",
+        sorted(data.column("import_ctry").unique().to_pylist()),
+    )
+
+    # Weighted edges
+    weighted = st.checkbox("Weighted Edges by Quantity of Trades")
+
+    # Node Centrality
+    centrality = None
+    dgree = st.checkbox("Scale Nodes by Number of Trading Partners", value=True)
+    if dgree:
+        centrality = st.radio(
+                "Scale Nodes by Centrality Measures",
+                ["Degree (connections)",
+                    "In-Degree (incoming connections)",
+                    "Out-Degree (outgoing connections)",
+                    #"Eigenvector (centrality of neighbors)",
+                    "Closeness (distance to other nodes)",
+                    "Betweenness (frequency as shortest path)"])
+               # captions = ["number of edges",
+               #     "centrality of neighbors",
+               #     "shortest path to other nodes"])
+
+    html = build_graph_html(
+        version, taxon, year_from, year_to, term, weighted, centrality
+    )
+
+    # Color based on import/export, applied to the cached page on load
+    colors = {im_filter: "red", ex_filter: "orange"}
+    recolor = json.dumps([{"id": n, "color": c} for n, c in colors.items()])
+    html = html.replace(
+        "</body>", f"<script>nodes.update({recolor});</script></body>"
+    )
+
+    # Load HTML in HTML component for display on Streamlit page
+    components.html(html, height=1500, width=1500)
+
+    st.write("Trade Weights by Countries")
+    st.dataframe(data)
+
+    st.write("Raw data")
+    st.dataframe(
+        load_raw(version, taxon, year_from, year_to, term), hide_index=True
+    )
+
+
+# Cached queries take the parquet file's modification time as an argument, so
+# rewriting the file (e.g. with prepare_data.py) invalidates their results
+data_version = os.path.getmtime(DATA_PATH)
+
+# Read dataset (Parquet) and summary data
+tax, summary = load_landing(data_version)
+taxon_num, import_num, export_num = (str(n) for n in summary)
 colA, colB, colC = st.columns(3)
 colA.metric(label="Taxa ♞", value=taxon_num)
 colB.metric(label="Exporters →", value=export_num)
 colC.metric(label="Importers ←", value=import_num)
 
-sp_filter = st.selectbox("Select/Type the Taxon", pd.unique(tax["Taxon"].sort_values()))
+sp_filter = st.selectbox("Select/Type the Taxon", tax)
 
 if sp_filter:
     # Filter for year of trade
     term_check = st.checkbox("Select Term")
     yrs = st.slider("Select Trade Years", 1974, 2023, (1975, 2022))
     if term_check:
-        term_query = (
-            "select distinct c.Term from 'data/cites_data.parquet' c where c.Taxon = '"
-            + sp_filter
-            + "' and c.Year >= '"
-            + str(yrs[0])
-            + "' and c.Year <= '"
-            + str(yrs[1])
-            + "'"
-        )
-        term = dk.query(term_query).df()
-        if term.empty:
+        term = get_terms(data_version, sp_filter, yrs[0], yrs[1])
+        if not term:
             # REGISTER to track whether term query is empty
             REGISTER = 0
         else:
-            term_filter = st.selectbox(
-                "Select/Type the Term", pd.unique(term["Term"].sort_values())
-            )
-            query = (
-                """select c.Exporter as exporter
-                ,c.export_ctry
-                ,c.Importer as importer
-                ,c.import_ctry
-                ,sum(c.Quantity) as weight
-                from 'data/cites_data.parquet' c
-                where c.Taxon = '"""
-                + sp_filter
-                + "' and c.Year >= '"
-                + str(yrs[0])
-                + "' and c.Year <= '"
-                + str(yrs[1])
-                + "' and c.Term = '"
-                + term_filter
-                + "' group by c.Exporter, c.export_ctry, c.Importer, c.import_ctry"
-            )
-            query_full = (
-                "select * from 'data/cites_data.parquet' c where c.Taxon = '"
-                + sp_filter
-                + "' and c.Year >= '"
-                + str(yrs[0])
-                + "' and c.Year <= '"
-                + str(yrs[1])
-                + "' and c.Term = '"
-                + term_filter
-                + "'"
-            )
+            term_filter = st.selectbox("Select/Type the Term", term)
             REGISTER = 1
     else:
-        query = (
-            """select c.Exporter as exporter
-            ,c.export_ctry
-            ,c.Importer as importer
-            ,c.import_ctry
-            ,sum(c.Quantity) as weight
-            from 'data/cites_data.parquet' c
-            where c.Taxon = '"""
-            + sp_filter
-            + "' and c.Year >= '"
-            + str(yrs[0])
-            + "' and c.Year <= '"
-            + str(yrs[1])
-            + "' group by c.Exporter, c.export_ctry, c.Importer, c.import_ctry"
-        )
-        query_full = (
-            "select * from 'data/cites_data.parquet' c where c.Taxon = '"
-            + sp_filter
-            + "' and c.Year >= '"
-            + str(yrs[0])
-            + "' and c.Year <= '"
-            + str(yrs[1])
-            + "'"
-        )
+        term_filter = None
         REGISTER = 1
     # Query data
     if REGISTER == 0:
-        data = pd.DataFrame()
+        num_results = 0
     else:
-        data = dk.query(query).df()
-    if data.empty:
+        data = filter_by_taxon(data_version, sp_filter, yrs[0], yrs[1], term_filter)
+        num_results = data.num_rows
+    if num_results == 0:
         st.write("No results, please expand years.")
     else:
-        num_results = len(data.index)
         RES_STMNT = "Results returned: " + str(num_results)
         st.write(RES_STMNT)
         if num_results < 1000:
-            full_data = dk.query(query_full).df()
-            full_data["Id"] = full_data["Id"].astype(str)
-            full_data["Year"] = full_data["Year"].astype(str)
-
-            # Select Importer and Exporter colors
-            ex_filter = st.selectbox(
-                "Select/Type the :orange[Exporter]",
-                pd.unique(data["export_ctry"].sort_values()),
-            )
-            im_filter = st.selectbox(
-                "Select/Type the :red[Importer]",
-                pd.unique(data["import_ctry"].sort_values()),
-            )
-
-            # Weighted edges
-            weighted = st.checkbox("Weighted Edges by Quantity of Trades")
-            if weighted:
-                species = nx.from_pandas_edgelist(
-                    data,
-                    source="export_ctry",
-                    target="import_ctry",
-                    edge_attr="weight",
-                    create_using=nx.DiGraph(),
-                )
-                #print(species.edge_attr)
-            else:
-                species = nx.from_pandas_edgelist(
-                    data,
-                    source="export_ctry",
-                    target="import_ctry",
-                    create_using=nx.DiGraph(),
-                )
-            
-            # Node Centrality
-            dgree = st.checkbox("Scale Nodes by Number of Trading Partners", value=True)
-            if dgree:
-                centrality = st.radio(
-                        "Scale Nodes by Centrality Measures",
-                        ["Degree (connections)",
-                            "In-Degree (incoming connections)",
-                            "Out-Degree (outgoing connections)",
-                            #"Eigenvector (centrality of neighbors)",
-                            "Closeness (distance to other nodes)",
-                            "Betweenness (frequency as shortest path)"])
-                       # captions = ["number of edges",
-                       #     "centrality of neighbors",
-                       #     "shortest path to other nodes"])
-            
-                # Adding scaling for node size
-                if centrality == "Degree (connections)":
-                    cent = nx.degree_centrality(species)
-                    cent.update((x, 100 * y) for x, y in cent.items())
-                    nx.set_node_attributes(species, cent, "size")
-                elif centrality == "In-Degree (incoming connections)":
-                    cent = nx.in_degree_centrality(species)
-                    cent.update((x, 100 * y) for x, y in cent.items())
-                    nx.set_node_attributes(species, cent, "size")
-                elif centrality == "Out-Degree (outgoing connections)":
-                    cent = nx.out_degree_centrality(species)
-                    cent.update((x, 100 * y) for x, y in cent.items())
-                    nx.set_node_attributes(species, cent, "size")
-                elif centrality == "Eigenvector (centrality of neighbors)":
-                    cent = nx.eigenvector_centrality(species)
-                    cent.update((x, 100 * y) for x, y in cent.items())
-                    nx.set_node_attributes(species, cent, "size")
-                elif centrality == "Closeness (shortest path to other nodes)":
-                    cent = nx.closeness_centrality(species)
-                    cent.update((x, 100 * y) for x, y in cent.items())
-                    nx.set_node_attributes(species, cent, "size")
-                elif centrality == "Betweenness (frequency as shortest path)":
-                    cent = nx.betweenness_centrality(species)
-                    cent.update((x, 100 * y) for x, y in cent.items())
-                    nx.set_node_attributes(species, cent, "size")
-
-
-            # Take Networkx graph and translate it to a PyVis graph format
-            anim_net = Network(
-                height="900px", bgcolor="white", font_color="blue", directed=True
-            )
-            anim_net.from_nx(species)
-
-            # Color based on import/export
-            for node in anim_net.nodes:
-                if node["id"] == ex_filter:
-                    node["color"] = "orange"
-                elif node["id"] == im_filter:
-                    node["color"] = "red"
-                else:
-                    node["color"] = "grey"
-
-            # Generate network with specific layout settings
-            anim_net.repulsion(
-                node_distance=420,
-                central_gravity=0.33,
-                spring_length=110,
-                spring_strength=0.10,
-                damping=0.95,
-            )
-
-            # Save and read graph as HTML file (on Streamlit Sharing)
-            try:
-                PATH = "/tmp"
-                anim_net.save_graph(f"{PATH}/pyvis_graph.html")
-                HtmlFile = open(f"{PATH}/pyvis_graph.html", "r", encoding="utf-8")
-
-            # Save and read graph as HTML file (locally)
-            except OSError:
-                PATH = "html_files"
-                anim_net.save_graph(f"{PATH}/pyvis_graph.html")
-                HtmlFile = open(f"{PATH}/pyvis_graph.html", "r", encoding="utf-8")
-
-            # Load HTML file in HTML component for display on Streamlit page
-            components.html(HtmlFile.read(), height=1500, width=1500)
-            HtmlFile.close()
-            
-            st.write("Trade Weights by Countries")
-            st.dataframe(data)
-
-            st.write("Raw data")
-            st.dataframe(full_data.set_index(full_data.columns[0]))
-
+            render_graph(data_version, sp_filter, yrs[0], yrs[1], term_filter)
         else:
             st.write("Too many nodes to plot, please narrow search.")
 